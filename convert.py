@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import sys
 import shutil
@@ -8,9 +9,35 @@ import logging
 import json
 import hashlib
 import stat
+import tarfile
+import pickle
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 jsonSep = (',', ':')
 
+def jsonBytes(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=jsonSep).encode('ascii')
+
+def jsonRead(path):
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 def mkdir(path, skipIfExist=False):
     if os.path.exists(path):
         if skipIfExist and os.path.isdir(path):
@@ -19,17 +46,68 @@ def mkdir(path, skipIfExist=False):
     os.mkdir(path)
     return True
 
+madeDirs = set()
+
+def ensureDir(path):
+    if path in madeDirs:
+        return
+    os.makedirs(path, exist_ok=True)
+    madeDirs.add(path)
+
 def relPath(*paths):
+    base = os.path.join(*paths)
+    prefix = base + '/'
     def absPath(*subpaths):
-        return os.path.join(*paths, *subpaths)
+        if not subpaths:
+            return base
+        return prefix + '/'.join(subpaths)
     return absPath
 
-def sha256sum(path):
-    p1 = subprocess.Popen(['sha256sum', path], stdout=subprocess.PIPE)
-    p2 = subprocess.Popen(['awk', '{print $1}'], stdin=p1.stdout, stdout=subprocess.PIPE)
-    p1.stdout.close()
-    checksum = p2.communicate()[0].decode('utf-8').removesuffix('\n')
-    return checksum
+mmapThreshold = 8 << 20
+
+def hashFile(path, digest):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > mmapThreshold:
+            with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+                h = digest()
+                h.update(mm)
+                return h.hexdigest()
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, digest).hexdigest()
+        h = digest()
+        buf = bytearray(1 << 20)
+        mv = memoryview(buf)
+        while (n := f.readinto(mv)):
+            h.update(mv[:n])
+        return h.hexdigest()
+
+def poolHash():
+    if blake3 is not None:
+        return blake3.blake3()
+    return hashlib.sha256()
+
+def poolDigest(path):
+    if blake3 is not None:
+        return hashFile(path, blake3.blake3)
+    return hashFile(path, hashlib.sha256)
+
+tarTypeModes = {
+    tarfile.DIRTYPE: stat.S_IFDIR,
+    tarfile.SYMTYPE: stat.S_IFLNK,
+    tarfile.CHRTYPE: stat.S_IFCHR,
+    tarfile.BLKTYPE: stat.S_IFBLK,
+    tarfile.FIFOTYPE: stat.S_IFIFO,
+}
+
+class HashWriter:
+    def __init__(self, f, h):
+        self.f = f
+        self.h = h
+
+    def write(self, data):
+        self.h.update(data)
+        return self.f.write(data)
 
 class Layer:
     def __init__(self, path):
@@ -38,12 +116,79 @@ class Layer:
         _, self.id = os.path.split(dirpath)
 
     def unpack(self, dst):
-        mkdir(dst, skipIfExist=True)
+        ensureDir(dst)
         path = os.path.join(dst, self.id, 'layer')
         os.makedirs(path)
-        subprocess.run(['tar', '-xf', self.src, '-C', path])
+        with tarfile.open(self.src, 'r|*') as tf:
+            tf.extractall(path, filter='fully_trusted')
         return UnpackedLayer(path)
 
+    def convert(self, dst, pool):
+        seen = set(os.listdir(pool))
+        spool = os.path.join(pool, '.spool-' + self.id)
+        root = {'mode': stat.S_IFDIR | 0o755, 'dirents': {}}
+        files = {}
+        with tarfile.open(self.src, 'r|*') as tf:
+            for info in tf:
+                parts = [p for p in info.name.split('/') if p and p != '.']
+                entry = root
+                for name in parts:
+                    entry = entry['dirents'].setdefault(name,
+                        {'mode': stat.S_IFDIR | 0o755, 'dirents': {}})
+                if info.isdir():
+                    entry['mode'] = stat.S_IFDIR | info.mode
+                    continue
+                entry.pop('dirents', None)
+                if info.issym():
+                    entry['mode'] = stat.S_IFLNK | info.mode
+                    entry['target'] = info.linkname
+                elif info.isreg():
+                    entry['mode'] = stat.S_IFREG | info.mode
+                    entry['size'] = info.size
+                    entry['digest'] = self._spool(tf.extractfile(info), info.size,
+                        pool, spool, seen)
+                    files['/'.join(parts)] = entry
+                elif info.islnk():
+                    other = files['/'.join(p for p in info.linkname.split('/')
+                        if p and p != '.')]
+                    entry['mode'] = stat.S_IFREG | info.mode
+                    entry['size'] = other['size']
+                    entry['digest'] = other['digest']
+                else:
+                    entry['mode'] = tarTypeModes.get(info.type, 0) | info.mode
+        return self._packMetadata(dst, jsonBytes(root))
+
+    def _spool(self, ef, size, pool, spool, seen):
+        if size > mmapThreshold:
+            with open(spool, 'wb') as f:
+                shutil.copyfileobj(ef, f, 1 << 20)
+            checksum = poolDigest(spool)
+        else:
+            h = poolHash()
+            with open(spool, 'wb') as f:
+                shutil.copyfileobj(ef, HashWriter(f, h), 1 << 20)
+            checksum = h.hexdigest()
+        if checksum in seen:
+            os.unlink(spool)
+        else:
+            os.rename(spool, os.path.join(pool, checksum))
+            seen.add(checksum)
+        return checksum
+
+    def _packMetadata(self, dst, body):
+        ensureDir(dst)
+        dirpath = os.path.join(dst, self.id)
+        os.makedirs(dirpath)
+        path = os.path.join(dirpath, 'layer.tar')
+        h = hashlib.sha256()
+        with open(path, 'wb') as f:
+            with tarfile.open(fileobj=HashWriter(f, h), mode='w|') as tf:
+                info = tarfile.TarInfo('./metadata.json')
+                info.size = len(body)
+                info.mode = 0o644
+                tf.addfile(info, io.BytesIO(body))
+        return h.hexdigest()
+
 class UnpackedLayer:
     def __init__(self, path):
         self.src = path
@@ -51,17 +196,20 @@ class UnpackedLayer:
         _, self.id = os.path.split(dirpath)
 
     def pack(self, dst):
-        mkdir(dst, skipIfExist=True)
+        ensureDir(dst)
         dirpath = os.path.join(dst, self.id)
         os.makedirs(dirpath)
         path = os.path.join(dirpath, 'layer.tar')
-        subprocess.run(['tar', '-cf', path, '-C', self.src, '.'])
-        return Layer(path)
+        h = hashlib.sha256()
+        with open(path, 'wb') as f:
+            with tarfile.open(fileobj=HashWriter(f, h), mode='w|') as tf:
+                tf.add(self.src, arcname='.')
+        return Layer(path), h.hexdigest()
     
-    def lazify(self, metadata):
+    def lazify(self, metadata, lazifier):
         lazifier.lazify(self.src, metadata)
         mkdir(self.src)
-        shutil.move(metadata, self.src)
+        shutil.move(metadata, os.path.join(self.src, 'metadata.json'))
 
 class Lazifier:
     def __init__(self, cmd):
@@ -70,7 +218,18 @@ class Lazifier:
     def lazify(self, root, output):
         subprocess.run([self.cmd, root, output])
 
-lazifier = Lazifier('cafs-convert')
+lazifier = None
+
+def assembleLayer(layer, dst, lazifier):
+    metadata = os.path.join(dst, layer.id + '.metadata.json')
+    layer.lazify(metadata, lazifier)
+    _, checksum = layer.pack(dst)
+    return layer.id, 'sha256:' + checksum
+
+def processLayer(layer, tmp, dst, pool, lazifier):
+    if lazifier is None:
+        return layer.id, 'sha256:' + layer.convert(dst, pool)
+    return assembleLayer(layer.unpack(tmp), dst, lazifier)
 
 class Image:
     def __init__(self, path):
@@ -79,37 +238,45 @@ class Image:
         self._src = relPath(self._name, 'orig')
         self._dst = relPath(self._name, 'lazy')
         self._tmp = relPath(self._name, 'temp')
+        self._pool = relPath(self._name, 'pool')
         self._target = self._name + '-lazy.tar'
         mkdir(self._name, skipIfExist=True)
 
     def convert(self):
         self._untar()
         self._loadManifest()
-        self._unpackLayers()
         self._assembleLayers()
         self._writeConfigs()
         self._assembleTarget()
 
     def _assembleTarget(self):
-        subprocess.run(['tar', '-cf', self._target, '-C', self._dst(), '.'])
+        with tarfile.open(self._target, 'w') as tf:
+            tf.add(self._dst(), arcname='.')
 
     def _assembleLayers(self):
+        if lazifier is not None:
+            mkdir(self._tmp())
         mkdir(self._dst())
+        ensureDir(self._pool())
+        n = len(self._layers)
+        with ProcessPoolExecutor(max_workers=self._workers()) as ex:
+            checksums = dict(ex.map(processLayer, self._layers,
+                [self._tmp()] * n, [self._dst()] * n, [self._pool()] * n,
+                [lazifier] * n))
         self._config['rootfs']['diff_ids'] = []
-        for layer in self._unpackedLayers:
-            layer.lazify('metadata.json')
-            packedLayer = layer.pack(self._dst())
-            checksum = 'sha256:' + sha256sum(packedLayer.src)
+        for layer in self._layers:
+            checksum = checksums[layer.id]
             self._config['rootfs']['diff_ids'].append(checksum)
             logging.info(f'assembled layer {checksum}')
             shutil.copyfile(self._src(layer.id, 'VERSION'), self._dst(layer.id, 'VERSION'))
             shutil.copyfile(self._src(layer.id, 'json'), self._dst(layer.id, 'json'))
 
     def _writeConfigs(self):
-        configHash = hashlib.sha256(json.dumps(self._config, separators=jsonSep).encode('ascii')).hexdigest()
+        body = jsonBytes(self._config)
+        configHash = hashlib.sha256(body).hexdigest()
         configName = configHash + '.json'
-        with open(self._dst(configName), 'w') as fp:
-            json.dump(self._config, fp, separators=jsonSep)
+        with open(self._dst(configName), 'wb') as fp:
+            fp.write(body)
         self._manifest[0]['Config'] = configName
         tags = []
         for tag in self._manifest[0]['RepoTags']:
@@ -119,19 +286,15 @@ class Image:
             del self._repositories[name][ver]
             tags.append(':'.join([name, newver]))
         self._manifest[0]['RepoTags'] = tags
-        with open(self._dst('repositories'), 'w') as fp:
-            json.dump(self._repositories, fp, separators=jsonSep)
-            fp.write('\n')
-        with open(self._dst('manifest.json'), 'w') as fp:
-            json.dump(self._manifest, fp, separators=jsonSep)
-            fp.write('\n')
-
-    def _unpackLayers(self):
-        mkdir(self._tmp())
-        self._unpackedLayers = []
-        for layer in self._layers:
-            unpackedLayer = layer.unpack(self._tmp())
-            self._unpackedLayers.append(unpackedLayer)
+        with open(self._dst('repositories'), 'wb') as fp:
+            fp.write(jsonBytes(self._repositories))
+            fp.write(b'\n')
+        with open(self._dst('manifest.json'), 'wb') as fp:
+            fp.write(jsonBytes(self._manifest))
+            fp.write(b'\n')
+
+    def _workers(self):
+        return max(1, min(len(self._layers), os.cpu_count() or 1))
 
     def _untar(self):
         filename, dirname = self._srcTar, self._src()
@@ -139,17 +302,36 @@ class Image:
         if not mkdir(dirname, skipIfExist=True):
             logging.info(f'directory "{dirname}" already exists, skipping untar')
             return
-        code = subprocess.call(['tar', '-xf', filename, '-C', dirname])
-        if code != 0:
-            logging.fatal(f'failed to untar {filename}, exitcode {code}')
+        try:
+            with tarfile.open(filename) as tf:
+                tf.extractall(dirname, filter='fully_trusted')
+        except (OSError, tarfile.TarError) as e:
+            logging.fatal(f'failed to untar {filename}: {e}')
+
+    def _statKey(self, *names):
+        key = []
+        for name in names:
+            s = os.stat(self._src(name))
+            key.append((name, s.st_mtime_ns, s.st_size))
+        return key
 
     def _loadManifest(self):
-        with open(self._src('manifest.json')) as fp:
-            self._manifest = json.load(fp)
-        with open(self._src('repositories')) as fp:
-            self._repositories = json.load(fp)
-        with open(self._src(self._manifest[0]['Config'])) as fp:
-            self._config = json.load(fp)
+        cachePath = self._name + '.parsecache'
+        try:
+            with open(cachePath, 'rb') as fp:
+                key, manifest, repositories, config = pickle.load(fp)
+            if key != self._statKey('manifest.json', 'repositories', manifest[0]['Config']):
+                raise ValueError('parse cache is stale')
+            self._manifest, self._repositories, self._config = manifest, repositories, config
+        except (OSError, EOFError, ValueError, TypeError, KeyError, IndexError,
+                pickle.PickleError):
+            self._manifest = jsonRead(self._src('manifest.json'))
+            self._repositories = jsonRead(self._src('repositories'))
+            self._config = jsonRead(self._src(self._manifest[0]['Config']))
+            key = self._statKey('manifest.json', 'repositories', self._manifest[0]['Config'])
+            with open(cachePath + '.tmp', 'wb') as fp:
+                pickle.dump((key, self._manifest, self._repositories, self._config), fp)
+            os.rename(cachePath + '.tmp', cachePath)
         self._layers = [Layer(self._src(x)) for x in self._manifest[0]['Layers']]
         repoTags = self._manifest[0]['RepoTags']
         logging.info(f'parse manifest success, RepoTags = {repoTags}')
@@ -161,9 +343,10 @@ if __name__ == '__main__':
             '\n  tarball\n' +
             '       The image.tar created by docker save.\n' +
             '\n  lazifier\n' +
-            '       A command which takes 2 arguments: <root> <meta>\n' +
+            '       An optional command which takes 2 arguments: <root> <meta>\n' +
             '       It will traverse the <root> directory tree, save the tree structure in <meta>,\n' +
-            '       and stash the content of regular files into the pool based on its sha256sum.')
+            '       and stash the content of regular files into the pool based on its sha256sum.\n' +
+            '       If omitted, a built-in converter stashes file contents into <image>/pool.')
         sys.exit(-1)
     if len(sys.argv) > 2:
         lazifier = Lazifier(sys.argv[2])